@@ -132,6 +132,7 @@ def main() -> None:
     parser.add_argument('limit_files', nargs='*', help="Speed up dev-builds by only building a specific set of one or more calculators")
 
     parser.add_argument('--watch', action='store_true', help="Watch source files and automatically rebuild when they change")
+    parser.add_argument('--parallel', action='store_true', help="Run build steps that do not depend on each other at the same time")
     # parser.add_argument('--draft', action='store_true', help="Enable all speed up flags for dev builds")
 
     # # parser.add_argument('--no-jslint', action='store_true', help="Speed up dev-builds by skipping linting javascript files")
@@ -201,7 +202,8 @@ def main() -> None:
         initial_filepaths=Scheduler.all_paths_in_dir(
             base_dir=".",
             ignore_paths=["venv_docker", "venv", ".git", "node_modules", "output_master"]
-        )
+        ),
+        parallel=args.parallel,
     )
 
 
@@ -239,6 +241,8 @@ def main() -> None:
 
         observer.join()
 
+    scheduler.close()
+
 
 class Handler(FileSystemEventHandler):
     def __init__(self, event_queue: queue.Queue):
@@ -1,4 +1,5 @@
-from typing import List, Callable, Any, Set, Generic
+from typing import List, Callable, Any, Set, Generic, Optional
+import sys
 
 from .producer import InputFileDatatype, OutputFileDatatype
 
@@ -27,6 +28,14 @@ class Creator(Generic[InputFileDatatype, OutputFileDatatype]):
         self.function: Callable[[InputFileDatatype, OutputFileDatatype], None] = function
         self.categories: List[str] = categories
 
+        # The flattened input and output paths are memoized the first time
+        # they are requested because the scheduler asks for them repeatedly.
+        # The paths are interned so that the same file referenced by several
+        # creators, and by the scheduler's input and output file maps, is a
+        # single shared string.
+        self._flat_input_paths: Optional[List[str]] = None
+        self._flat_output_paths: Optional[List[str]] = None
+
         # Pre-cache the input files in a set for very fast file lookups.
         self._input_paths_set: Set[str] = set(self.flat_input_paths())
 
@@ -45,36 +54,44 @@ class Creator(Generic[InputFileDatatype, OutputFileDatatype]):
     #
     ############################################################################
     def flat_input_paths(self) -> List[str]:
+        if self._flat_input_paths is not None:
+            return self._flat_input_paths
+
         flat_input_paths: List[str] = []
         for input_path in self.input_paths.values():  # type:ignore # Typed Dict is secretly a dict but technically not
             if isinstance(input_path, str):
-                flat_input_paths.append(input_path)
+                flat_input_paths.append(sys.intern(input_path))
 
             elif isinstance(input_path, list) and all([isinstance(x, str) for x in input_path]):
                 for sub_input_path in input_path:
-                    flat_input_paths.append(sub_input_path)
+                    flat_input_paths.append(sys.intern(sub_input_path))
 
             else:
                 raise TypeError("Expected either a string or a list of strings but got", input_path)
 
+        self._flat_input_paths = flat_input_paths
         return flat_input_paths
 
     ############################################################################
     #
     ############################################################################
     def flat_output_paths(self) -> List[str]:
+        if self._flat_output_paths is not None:
+            return self._flat_output_paths
+
         flat_output_paths: List[str] = []
         for output_path in self.output_paths.values():  # type:ignore # Typed Dict is secretly a dict but technically not
             if isinstance(output_path, str):
-                flat_output_paths.append(output_path)
+                flat_output_paths.append(sys.intern(output_path))
 
             elif isinstance(output_path, list) and all([isinstance(x, str) for x in output_path]):
                 for sub_output_path in output_path:
-                    flat_output_paths.append(sub_output_path)
+                    flat_output_paths.append(sys.intern(sub_output_path))
 
             else:
                 raise TypeError("Expected either a string but got", output_path)
 
+        self._flat_output_paths = flat_output_paths
         return flat_output_paths
 
     ############################################################################
@@ -1,13 +1,15 @@
-from typing import List, Callable, Any, Optional, Tuple, Dict, Set
+from typing import List, Callable, Any, Optional, Tuple, Dict, Set, Union, Iterator
+import concurrent.futures
 import os
 import re
 import sqlite3
+import stat
 import sys
 import time
-import json
 
 from .producer import GenericProducer
 from .creator import Creator
+from .stat_cache import StatCache
 from pylib.unique_heap import UniqueHeap
 from pylib.terminal_color import fg_gray
 
@@ -21,15 +23,150 @@ GenericCreator = Creator[Any, Any]
 
 ProducerIndexType = int
 
-# Tuple[ProducerId, StringifiedOrHashedGroups]
+# The number of directories that have to be waiting to be scanned before
+# scan_modified_times() will spread the scanning across a thread pool. Small
+# trees are faster to walk on one thread than to hand off to other threads.
+PARALLEL_SCAN_MIN_DIRECTORIES = 4
+
+# If os.scandir() can list a directory from an open file descriptor then the
+# children can be stat'd relative to that descriptor, instead of the kernel
+# resolving every component of their full paths again for each stat.
+SCANDIR_SUPPORTS_FD = os.scandir in os.supports_fd and hasattr(os, "O_DIRECTORY")
+
+# Tuple[ProducerId, SortedGroupItems]
 # Keeping the producerindex first in this tuple is important for sorting reasons
-CreatorIndexType = Tuple[ProducerIndexType, str]
+MatchGroupsType = Tuple[Tuple[str, str], ...]
+CreatorIndexType = Tuple[ProducerIndexType, MatchGroupsType]
+
+
+################################################################################
+# get_hashable_matchgroups
+#
+# Convert a dict of match groups into a canonical hashable key. The items are
+# sorted so the same groups always produce the same key.
+################################################################################
+def get_hashable_matchgroups(groups: Dict[str, str]) -> MatchGroupsType:
+    return tuple(sorted(groups.items()))
+
+
+################################################################################
+# get_pattern_extension
+#
+# Statically find the file extension that any path matching a regex pattern
+# must end in, eg ".json" for r"^cache/(?P<dir>[a-z]+)/data\.json$". Returns
+# None if the pattern does not end in a fixed literal extension, or if it uses
+# anything that could make the extension vary such as a top level alternation
+# or a flag like IGNORECASE. This is intentionally conservative, a None simply
+# means that the pattern has to be checked against every path.
+################################################################################
+def get_pattern_extension(pattern: str, flags: int = 0) -> Optional[str]:
+    if flags & (re.IGNORECASE | re.MULTILINE | re.VERBOSE):
+        return None
+
+    # Each token is either a literal character, None for anything that does
+    # not match exactly one fixed character, or end_anchor for a top level $.
+    # The end anchor is an empty string so that it can never be equal to a
+    # literal character, including an escaped \$.
+    end_anchor = ""
+    tokens: List[Optional[str]] = []
+    depth = 0
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+
+        if character == "\\":
+            if index + 1 >= len(pattern):
+                return None
+            escaped = pattern[index + 1]
+            # Escaped letters and digits are character classes, anchors, or
+            # backreferences. Anything else is a literal character.
+            tokens.append(None if escaped.isalnum() else escaped)
+            index += 2
+            continue
+
+        if character == "[":
+            # Skip over the whole character class
+            index += 1
+            if index < len(pattern) and pattern[index] == "^":
+                index += 1
+            if index < len(pattern) and pattern[index] == "]":
+                index += 1
+            while index < len(pattern) and pattern[index] != "]":
+                if pattern[index] == "\\":
+                    index += 1
+                index += 1
+            tokens.append(None)
+
+        elif character in "*+?{":
+            # A quantifier means the previous token might not be present
+            # exactly once.
+            if len(tokens) > 0:
+                tokens[-1] = None
+            if character == "{":
+                index = pattern.find("}", index)
+                if index == -1:
+                    return None
+            tokens.append(None)
+
+        elif character == "|":
+            if depth == 0:
+                return None
+            tokens.append(None)
+
+        elif character == "(":
+            depth += 1
+            tokens.append(None)
+
+        elif character == ")":
+            depth -= 1
+            tokens.append(None)
+
+        elif character in ".^":
+            tokens.append(None)
+
+        elif character == "$":
+            tokens.append(end_anchor if depth == 0 else None)
+
+        else:
+            tokens.append(character)
+
+        index += 1
+
+    if len(tokens) == 0 or tokens[-1] != end_anchor:
+        return None
+
+    suffix = ""
+    for token in reversed(tokens[:-1]):
+        if token is None or token == end_anchor:
+            break
+        suffix = token + suffix
+
+    extension_start = suffix.rfind(".")
+    if extension_start == -1 or "/" in suffix[extension_start:]:
+        return None
+
+    return suffix[extension_start:]
+
+
+################################################################################
+# get_path_extension
+#
+# Get the extension of a path in the same form as get_pattern_extension(), the
+# text from the last "." in the final path component, or "" if there is none.
+################################################################################
+def get_path_extension(path: str) -> str:
+    # "$" can match right before a trailing newline so ignore it here as well
+    if path.endswith("\n"):
+        path = path[:-1]
 
+    filename = path[path.rfind("/") + 1:]
+    extension_start = filename.rfind(".")
+    if extension_start == -1:
+        return ""
 
+    return filename[extension_start:]
 
 
-def get_hashable_matchgroups(groups: Dict[str, str]) -> str:
-    return json.dumps(groups, sort_keys=True)
 ################################################################################
 # A controller and watcher for the set of producers and creators
 ################################################################################
@@ -42,7 +179,9 @@ class Scheduler:
     # last_creator_list_index: int
 
 
-    creator_list: Dict[CreatorIndexType, GenericCreator]
+    # The active creators, keyed first by the index of the producer that made
+    # them and then by the match groups that the creator was built from.
+    creator_list: Dict[ProducerIndexType, Dict[MatchGroupsType, GenericCreator]]
 
 
     # # A map of a creator index to a producer index that spawned the creator
@@ -58,8 +197,39 @@ class Scheduler:
 
     filecache: sqlite3.Connection
 
+    # The compiled regex for every producer field along with the producer
+    # index and field name, bucketed by the file extension that a path must
+    # have in order to match them. Built once so matching a path calls the
+    # pattern directly instead of going back through the producers and the
+    # `re` module cache. Patterns that do not require a specific extension are
+    # kept in _patterns_without_extension and are checked against every path.
+    _patterns_by_extension: Dict[str, List[Tuple[ProducerIndexType, str, "re.Pattern[str]"]]]
+    _patterns_without_extension: List[Tuple[ProducerIndexType, str, "re.Pattern[str]"]]
+
+    # Snapshots of the producer lookup helpers so that the per-row work in
+    # query_filesets() does not need to call back into the producers.
+    _input_path_patterns_by_producer: List[Dict[str, Union[str, List[str]]]]
+    _field_id: Dict[Tuple[ProducerIndexType, str], str]
+    _match_group_id: Dict[Tuple[ProducerIndexType, str], str]
+
+    # Pre-built SQL query strings. None of these depend on the files being
+    # processed so they are built once instead of on every call.
+    _insert_sql: Dict[Tuple[ProducerIndexType, str], str]
+    _delete_sql: Dict[Tuple[ProducerIndexType, str], str]
+    _fileset_sql: Dict[ProducerIndexType, str]
+
+    # The generation that files inserted into the database are tagged with.
+    # A fileset is new if any of its files was inserted in the current
+    # generation, and moving on to the next generation marks every file as
+    # old without having to touch any of the rows.
+    _generation: int
+
     verbose: bool = False
 
+    # A thread pool to run independent creators on, or None to run creators
+    # one at a time.
+    _executor: Optional[concurrent.futures.ThreadPoolExecutor]
+
     ############################################################################
     #
     ############################################################################
@@ -68,19 +238,80 @@ class Scheduler:
         # producers: List[GenericProducer],
         producer_list: List[GenericProducer],
         # filepaths: List[str] = []
-        initial_filepaths: List[str] = []
+        initial_filepaths: List[str] = [],
+        parallel: bool = False,
     ):
         self.producer_list = producer_list
-        self.creator_list = {}
+        self.creator_list = {producer_index: {} for producer_index in range(len(producer_list))}
         # self.last_creator_list_index = -1
         # self.creator_producer = {}
         self.output_file_maps = {}
         self.input_file_maps = {}
 
+        self._patterns_by_extension = {}
+        self._patterns_without_extension = []
+        self._input_path_patterns_by_producer = []
+        self._field_id = {}
+        self._match_group_id = {}
+        self._insert_sql = {}
+        self._delete_sql = {}
+        for producer_index, producer in enumerate(self.producer_list):
+            input_path_patterns = producer.input_path_patterns_dict()
+            self._input_path_patterns_by_producer.append(input_path_patterns)
+
+            for field_name, pattern in producer.regex_field_patterns().items():
+                self._insert_sql[(producer_index, field_name)] = self.insert_new_file_querystring(producer_index, field_name)
+                self._delete_sql[(producer_index, field_name)] = self.remove_file_from_database_sql(producer_index, field_name)
+
+                # Look at the user's original pattern because the producer
+                # wraps ungrouped patterns in an extra group.
+                original_pattern = input_path_patterns[field_name]
+                if isinstance(original_pattern, list):
+                    original_pattern = original_pattern[0]
+
+                extension = get_pattern_extension(original_pattern, pattern.flags)
+                if extension is None:
+                    self._patterns_without_extension.append((producer_index, field_name, pattern))
+                    continue
+
+                if extension not in self._patterns_by_extension:
+                    self._patterns_by_extension[extension] = []
+                self._patterns_by_extension[extension].append((producer_index, field_name, pattern))
+
+            for field_name in input_path_patterns:
+                self._field_id[(producer_index, field_name)] = producer.get_field_id(field_name)
+
+            for group_name in producer.get_all_match_groups():
+                self._match_group_id[(producer_index, group_name)] = producer.get_match_group_id(group_name)
+
+        self._fileset_sql = {}
+        for producer_index in range(len(self.producer_list)):
+            self._fileset_sql[producer_index] = self.new_filesets_querystring(producer_index)
+
+        self._generation = 1
+
         self.filecache = self.init_producer_cache(self.producer_list)
 
+        # Threads are used instead of processes because creator functions are
+        # often closures that cannot be pickled, and most of the slow creators
+        # spend their time in subprocesses or IO that does not hold the GIL.
+        self._executor = None
+        if parallel:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
         self.add_or_update_files(initial_filepaths)
 
+    ############################################################################
+    # close
+    #
+    # Shut down the thread pool used to run creators in parallel, if there is
+    # one. The scheduler should not process any more files after this.
+    ############################################################################
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
     ############################################################################
     # add_or_update_files
     #
@@ -93,6 +324,24 @@ class Scheduler:
         self.process_files(files)
 
 
+    ############################################################################
+    # get_creator
+    #
+    # Look up a single creator by its creator index.
+    ############################################################################
+    def get_creator(self, creator_index: CreatorIndexType) -> GenericCreator:
+        producer_index, match_groups = creator_index
+        return self.creator_list[producer_index][match_groups]
+
+    ############################################################################
+    # all_creators
+    #
+    # Iterate over every active creator from every producer.
+    ############################################################################
+    def all_creators(self) -> Iterator[GenericCreator]:
+        for producer_creators in self.creator_list.values():
+            yield from producer_creators.values()
+
     ############################################################################
     # delete_creators_with_input_files
     #
@@ -112,36 +361,94 @@ class Scheduler:
         # to this creator. We do this instead of looping through all elements
         # in self.output_file_map so that we wont slow down this function as
         # more files are added to the list.
-        for creator_index in creator_indexes_to_delete:
-            self.delete_creator(creator_index)
+        self.delete_creators(creator_indexes_to_delete)
 
     def delete_creator(self, creator_index: CreatorIndexType) -> None:
-        creator = self.creator_list[creator_index]
-        for output_file in creator.flat_output_paths():
+        self.delete_creators({creator_index})
+
+    ############################################################################
+    # delete_creators
+    #
+    # Delete a batch of creators along with all of their input and output file
+    # cache references. The input file cache is updated once per input file
+    # for the whole batch instead of once per input file of every creator.
+    ############################################################################
+    def delete_creators(self, creator_indexes: Set[CreatorIndexType]) -> None:
+        input_files: Set[str] = set()
+
+        for creator_index in creator_indexes:
+            producer_index, match_groups = creator_index
+            creator = self.creator_list[producer_index][match_groups]
+            for output_file in creator.flat_output_paths():
+
+                # Sanity check that the file is indeed a part of the creator we
+                # will be deleting.
+                output_file_creator_index = self.output_file_maps[output_file]
+                if output_file_creator_index != creator_index:
+                    raise ValueError("Trying to delete an output file index for a creator which is not being deleted")
 
-            # Sanity check that the file is indeed a part of the creator we
-            # will be deleting.
-            output_file_creator_index =self.output_file_maps[output_file]
-            if output_file_creator_index != creator_index:
-                raise ValueError("Trying to delete an output file index for a creator which is not being deleted")
+                del self.output_file_maps[output_file]
 
-            del self.output_file_maps[output_file]
+            input_files.update(creator.flat_input_paths())
 
-        # Delete any input file cache reference to this creator
-        for input_file in creator.flat_input_paths():
-            self.input_file_maps[input_file].remove(creator_index)
+            # Delete the creator itself
+            del self.creator_list[producer_index][match_groups]
 
-            # If this was the last creator this file referenced then delete
+        # Delete any input file cache reference to these creators
+        for input_file in input_files:
+            remaining_creator_indexes = self.input_file_maps[input_file] - creator_indexes
+
+            # If these were the last creators this file referenced then delete
             # the entire element to keep it clean.
-            if len(self.input_file_maps[input_file]) == 0:
+            if len(remaining_creator_indexes) == 0:
                 del self.input_file_maps[input_file]
+            else:
+                self.input_file_maps[input_file] = remaining_creator_indexes
+
+    ############################################################################
+    # match_path
+    #
+    # Classify a path in a single pass over the producer fields, returning
+    # the producer index, field name, and regex match for each field that the
+    # path matches. A path can match any number of fields across producers.
+    # Only the fields that could possibly match the path's extension are run.
+    ############################################################################
+    def match_path(self, path: str) -> List[Tuple[ProducerIndexType, str, "re.Match[str]"]]:
+        matches: List[Tuple[ProducerIndexType, str, "re.Match[str]"]] = []
+
+        candidate_lists = (
+            self._patterns_by_extension.get(get_path_extension(path), []),
+            self._patterns_without_extension,
+        )
+        for candidates in candidate_lists:
+            for producer_index, field_name, pattern in candidates:
+                match: Optional[re.Match[str]] = pattern.match(path)
+
+                if match is None:
+                    continue
 
+                matches.append((producer_index, field_name, match))
 
-        # Delete the creator itself
-        del self.creator_list[creator_index]
+        return matches
 
+    ############################################################################
+    # group_field_matches
+    #
+    # Match every file against every producer field and group the filenames
+    # and their match groups by the field they matched. Duplicate files are
+    # only matched once so a file is never inserted into a table twice.
+    ############################################################################
+    def group_field_matches(self, files: List[str]) -> Dict[Tuple[ProducerIndexType, str], List[Tuple[str, Dict[str, str]]]]:
+        field_matches: Dict[Tuple[ProducerIndexType, str], List[Tuple[str, Dict[str, str]]]] = {}
+        for path in dict.fromkeys(files):
+            for producer_index, field_name, match in self.match_path(path):
+                field_key = (producer_index, field_name)
+                if field_key not in field_matches:
+                    field_matches[field_key] = []
 
+                field_matches[field_key].append((path, match.groupdict()))
 
+        return field_matches
 
     ############################################################################
     # build_new_creators
@@ -151,30 +458,42 @@ class Scheduler:
     # indexes of the creators that are created from them.
     ############################################################################
     def build_new_creators(self, files: List[str]) -> List[Tuple[ProducerIndexType, CreatorIndexType]]:
+        if len(files) == 0:
+            return []
+
         # Clean any creators that have any of these files as inputs
         self.delete_creators_with_input_files(files)
 
-        # Insert or update all files in the database
-        for producer_index, producer in enumerate(self.producer_list):
-            for path in files:
-                for field_name, pattern in producer.regex_field_patterns().items():
-                    match: Optional[re.Match[str]] = re.match(pattern, path)
+        # Group the matches by field so each field table can be updated with
+        # a single batched statement.
+        field_matches = self.group_field_matches(files)
 
-                    if match is None:
-                        continue
+        # If no producer pattern matched any of the files then there is nothing
+        # to write to the database and no new creators can be built.
+        if len(field_matches) == 0:
+            return []
 
-                    # Delete the file from the database if it exists
-                    self.remove_file_from_database(self.filecache, producer_index, field_name, path)
-
-                    # Insert a file into the database. If it already exists then
-                    # it is updated to be marked as a fresh file.
-                    self.insert_new_file(self.filecache, producer_index, field_name, path, match.groupdict())
+        # Only producers that have had a file inserted can have any updated
+        # rows, so these are the only producers that need to be queried for
+        # new creators.
+        updated_producers: Set[ProducerIndexType] = set()
+        for producer_index, _ in field_matches:
+            updated_producers.add(producer_index)
 
+        # Insert or update all files in the database in a single transaction
+        with self.filecache:
+            for (producer_index, field_name), matches in field_matches.items():
+                # Delete the files from the database if they exist
+                self.remove_files_from_database(self.filecache, producer_index, field_name, [filename for filename, _ in matches])
 
+                # Insert the files into the database, marked as fresh files.
+                self.insert_new_files(self.filecache, producer_index, field_name, matches)
 
         new_creators: List[Tuple[ProducerIndexType, CreatorIndexType]] = []
         # Build a list of creators
-        for producer_index, producer in enumerate(self.producer_list):
+        for producer_index in sorted(updated_producers):
+            producer = self.producer_list[producer_index]
+            producer_creators = self.creator_list[producer_index]
             input_datas = self.query_filesets(self.filecache, producer_index)
             for input_data in input_datas:
                 input_file, input_groups = input_data
@@ -194,25 +513,26 @@ class Scheduler:
                 )
 
 
-                new_creator_index: CreatorIndexType = (producer_index, get_hashable_matchgroups(input_groups))
+                match_groups = get_hashable_matchgroups(input_groups)
+                new_creator_index: CreatorIndexType = (producer_index, match_groups)
 
                 # Check if an old creator with all the same match-groups exists.
                 # The only time this will happen is if a creator is being
                 # remade. Then delete the old creator and any input/output
                 # caches it had.
-                if new_creator_index in self.creator_list:
+                if match_groups in producer_creators:
                     self.delete_creator(new_creator_index)
 
                 # Detect duplicate creators and error if any exist
                 for file in creator.flat_output_paths():
                     if file in self.output_file_maps:
                         raise ValueError("Two Creators with the same output file exist. Was a creator not destroyed properly before being remade?\n\tExisting:{existing_creator}\n\tNew:{new_creator}".format(
-                            existing_creator=self.creator_list[self.output_file_maps[file]],
+                            existing_creator=self.get_creator(self.output_file_maps[file]),
                             new_creator=creator
                         ))
 
                 # self.last_creator_list_index += 1
-                self.creator_list[new_creator_index] = creator
+                producer_creators[match_groups] = creator
                 # self.creator_producer[self.last_creator_list_index] = producer_index
                 new_creators.append((producer_index, new_creator_index))
 
@@ -226,18 +546,72 @@ class Scheduler:
                 for file in creator.flat_output_paths():
                     self.output_file_maps[file] = new_creator_index
 
-        self.mark_all_files_old(self.filecache)
+        # Every file that was just inserted has now been used to build
+        # creators, so start a new generation to mark them all as old.
+        self._generation += 1
 
         return new_creators
 
+    ############################################################################
+    # get_creator_depth
+    #
+    # Get the depth of a creator in the graph of creators, where one creator
+    # depends on another if it uses any of the other creator's output files as
+    # an input. Creators that do not depend on any others have a depth of 0 and
+    # every other creator is one deeper than the deepest creator it depends on.
+    # Depths are memoized in the creator_depths dict that is passed in.
+    ############################################################################
+    def get_creator_depth(self, creator_index: CreatorIndexType, creator_depths: Dict[CreatorIndexType, int]) -> int:
+        # Walk up the graph with an explicit stack instead of recursion so that
+        # long chains of creators cannot hit the recursion limit.
+        stack: List[CreatorIndexType] = [creator_index]
+        visiting: Set[CreatorIndexType] = set()
+        while len(stack) > 0:
+            current_index = stack[-1]
+            if current_index in creator_depths:
+                stack.pop()
+                continue
+
+            visiting.add(current_index)
+
+            dependencies: List[CreatorIndexType] = []
+            for input_file in self.get_creator(current_index).flat_input_paths():
+                if input_file in self.output_file_maps:
+                    dependencies.append(self.output_file_maps[input_file])
+
+            # Resolve the depths of the dependencies first. Dependencies that
+            # are already being visited are part of a cycle and are ignored.
+            unresolved = [x for x in dependencies if x not in creator_depths and x not in visiting]
+            if len(unresolved) > 0:
+                stack += unresolved
+                continue
+
+            depth = 0
+            for dependency in dependencies:
+                if dependency in creator_depths:
+                    depth = max(depth, creator_depths[dependency] + 1)
+
+            creator_depths[current_index] = depth
+            visiting.discard(current_index)
+            stack.pop()
+
+        return creator_depths[creator_index]
+
     ############################################################################
     # process_files
     #
     # Process a list of files through all of the currently active creators.
     ############################################################################
     def process_files(self, files: List[str]) -> None:
-        # Heap[Tuple[ProducerIndex, CreatorIndex]]
-        creators_to_update: UniqueHeap[CreatorIndexType] = UniqueHeap()
+        # The depth of each creator in the creator dependency graph
+        creator_depths: Dict[CreatorIndexType, int] = {}
+
+        # Heap[Tuple[CreatorDepth, CreatorIndex]]
+        # Ordering the heap by depth makes this a topological walk of the
+        # creators. Every creator is processed after all of the creators it
+        # depends on, even indirectly through creators that have not been
+        # added to the heap yet.
+        creators_to_update: UniqueHeap[Tuple[int, CreatorIndexType]] = UniqueHeap()
 
         # Fill the creators_to_update will all the producer/creator pairs
         for file in files:
@@ -245,85 +619,105 @@ class Scheduler:
             if file not in self.input_file_maps:
                 continue
 
-            creator_indexes: Set[CreatorIndexType] = self.input_file_maps[file]
-            for creator_index in creator_indexes:
-                creators_to_update.push(creator_index)
+            for creator_index in self.input_file_maps[file]:
+                creators_to_update.push((self.get_creator_depth(creator_index, creator_depths), creator_index))
+
+        # Cache the results of every os.stat() made while processing so that
+        # files shared between creators are not stat'd again for each one.
+        stat_cache = StatCache()
 
         # Process each creator until there are none left
         while len(creators_to_update) > 0:
-            creator_index: CreatorIndexType = creators_to_update.pop()
-            producer_index: ProducerIndexType = creator_index[0]
-
-            creator: GenericCreator = self.creator_list[creator_index]
-
-            output_files: List[str] = creator.flat_output_paths()
-            input_files: List[str] = creator.flat_input_paths()
-
-            if all_files_exist(creator.flat_output_paths()):
-                # If all of the output files are newer then all of the input files
-                # then do not regenerate this producer.
-                oldest_output = get_oldest_modified_time(output_files)
-                newest_input = get_newest_modified_time(input_files)
-                # "newer" is a larger number
-                if oldest_output > newest_input:
-                    continue
-
-            # Build creators for any of the files generated by this creator
-            # They will be picked up in the next step where we add them to the
-            # creators_to_update variable.
-            self.build_new_creators(output_files)
-
-            # Add the output files to the prioritized list of things to process.
-            # These will be automatically de-duplicated if they are already present.
-            # self.make_creators(output_files)
-            for file in output_files:
-                # If the file is not used in any creator, ignore it
-                if file not in self.input_file_maps:
+            # Take every creator at the shallowest depth. None of these can
+            # depend on each other so they can all be run at the same time.
+            depth, creator_index = creators_to_update.pop()
+            creator_indexes: List[CreatorIndexType] = [creator_index]
+            while len(creators_to_update) > 0 and creators_to_update.peek()[0] == depth:
+                creator_indexes.append(creators_to_update.pop()[1])
+
+            creators_to_run: List[GenericCreator] = []
+            for creator_index in creator_indexes:
+                # The creator may have been removed by one of its dependencies
+                # being rebuilt after it was added to the heap.
+                creator_producer_index, match_groups = creator_index
+                if match_groups not in self.creator_list[creator_producer_index]:
                     continue
 
-                creator_indexes: Set[CreatorIndexType] = self.input_file_maps[file]
-                for creator_index in creator_indexes:
-                    creators_to_update.push(creator_index)
-
-            # Pre-create any directories so the functions can always assume that
-            # the directories exist and just focus on creating the files.
-            build_required_directories(output_files)
-
-            print()
-            print(creator.categories)
-
+                creator: GenericCreator = self.creator_list[creator_producer_index][match_groups]
+
+                output_files: List[str] = creator.flat_output_paths()
+                input_files: List[str] = creator.flat_input_paths()
+
+                # Check that the outputs exist and get their age in the same pass
+                # so each output file is only stat'd once. This stops as soon as
+                # a missing output is found because the creator has to run.
+                oldest_output = get_existing_modified_time(output_files, min, stat_cache, self._executor)
+                if oldest_output is not None:
+                    # If all of the output files are newer then all of the input files
+                    # then do not regenerate this producer. A missing input is
+                    # treated as the newest possible file so the scan can stop
+                    # at the first one.
+                    _, newest_input = scan_modified_times(input_files, max, sys.float_info.max, stat_cache, self._executor, stop_at_missing=True)
+                    # "newer" is a larger number
+                    if oldest_output > newest_input:
+                        continue
 
-            if len(input_files) > 5:
-                print(fg_gray("  " + input_files[0]))
-                print(fg_gray("  " + input_files[1]))
-                print(fg_gray("  " + input_files[2]))
-                print(fg_gray("  " + input_files[3]))
-                print(fg_gray("  ...and {} other files".format(len(input_files)-4)))
+                # Build creators for any of the files generated by this creator
+                # They will be picked up in the next step where we add them to the
+                # creators_to_update variable.
+                new_creators = self.build_new_creators(output_files)
 
+                # The depths of any creators that were just rebuilt may have changed
+                for _, new_creator_index in new_creators:
+                    creator_depths.pop(new_creator_index, None)
 
-            else:
-                for i, file in enumerate(input_files):
-                    print(fg_gray("  " + file))
+                # Add the output files to the prioritized list of things to process.
+                # These will be automatically de-duplicated if they are already present.
+                for file in output_files:
+                    # If the file is not used in any creator, ignore it
+                    if file not in self.input_file_maps:
+                        continue
 
-            print(fg_gray("  │"))
+                    for dependent_creator_index in self.input_file_maps[file]:
+                        creators_to_update.push((self.get_creator_depth(dependent_creator_index, creator_depths), dependent_creator_index))
 
-            for i, file in enumerate(output_files):
+                # Pre-create any directories so the functions can always assume that
+                # the directories exist and just focus on creating the files.
+                build_required_directories(output_files, stat_cache)
 
-                pipe_character = "├"
-                if (i == len(output_files)-1):
-                    pipe_character = "└"
-                    # pipe_character = "╰"
+                creators_to_run.append(creator)
 
-                print(fg_gray("  {pipe_character}── {file}".format(
-                    pipe_character=pipe_character,
-                    file=file,
-                )))
+            self.run_creators(creators_to_run)
 
+            # The outputs have just been rewritten so any cached stats of them
+            # are out of date.
+            for creator in creators_to_run:
+                stat_cache.invalidate(creator.flat_output_paths())
 
-            start = time.time()
-            creator.run()
-            duration = time.time() - start
-            print(fg_gray("  Completed in {:.2f}s".format(duration)))
+    ############################################################################
+    # run_creators
+    #
+    # Run a list of creators that do not depend on each other. If the scheduler
+    # is running in parallel then they are run on the thread pool and each one
+    # is printed out when it finishes, otherwise they are run one at a time.
+    # All of the scheduler's own state is only ever touched by the main thread,
+    # only the creator functions themselves are run on the thread pool.
+    ############################################################################
+    def run_creators(self, creators: List[GenericCreator]) -> None:
+        if self._executor is None or len(creators) <= 1:
+            for creator in creators:
+                print_creator(creator)
+                duration = run_creator(creator)
+                print(fg_gray(format_duration(duration)))
+            return
+
+        futures: Dict[concurrent.futures.Future[float], GenericCreator] = {}
+        for creator in creators:
+            futures[self._executor.submit(run_creator, creator)] = creator
+
+        for future in concurrent.futures.as_completed(futures):
+            duration = future.result()
+            print_creator(futures[future], duration)
 
     ############################################################################
     # all_paths_in_dir
@@ -335,44 +729,70 @@ class Scheduler:
     def all_paths_in_dir(base_dir: str, ignore_paths: List[str]) -> List[str]:
         paths: List[str] = []
 
-        for root, dirs, files in os.walk(base_dir):
+        # str.startswith() can check every ignore path at once when given a
+        # tuple, which avoids a python loop over the ignore paths per entry.
+        ignore_prefixes = tuple(ignore_paths)
+
+        # Walk the directories in the same order os.walk() would, but using
+        # os.scandir() directly so that directories whose contents are all
+        # ignored are never scanned at all.
+        directories: List[str] = [base_dir]
+        while len(directories) > 0:
+            directory = directories.pop()
+
             # Strip the "current directory" prefix because that makes it more
             # annoying to match things on.
+            root = directory
             if root.startswith("./"):
                 root = root[2:]
 
+            # Every path inside a directory that matches an ignore path would
+            # also match it so there is no need to look inside.
+            if root.startswith(ignore_prefixes):
+                continue
+
+            try:
+                with os.scandir(directory) as entries:
+                    dirs: List[os.DirEntry[str]] = []
+                    files: List[os.DirEntry[str]] = []
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            dirs.append(entry)
+                        else:
+                            files.append(entry)
+            except OSError:
+                continue
+
             # Add all of the files and directories unless the path matches an ignore path
-            for path in dirs + files:
-                full_path = os.path.join(root, path)
-
-                skip = False
-                for ignore_path in ignore_paths:
-                    if full_path.startswith(ignore_path):
-                        skip = True
-                        break
-                if skip:
+            for entry in dirs + files:
+                full_path = os.path.join(root, entry.name)
+
+                if full_path.startswith(ignore_prefixes):
                     continue
 
                 paths.append(full_path)
 
+            # Like os.walk() do not follow symlinks to directories. Subdirectories
+            # are pushed in reverse so they are popped in listing order.
+            for entry in reversed(dirs):
+                if not entry.is_symlink():
+                    directories.append(entry.path)
+
         return paths
 
 
     def delete_files(self, files: List[str]) -> None:
         self.delete_creators_with_input_files(files)
-        # self.remove_files_from_database(files)
-        # self.remove_file_from_database
 
         # Delete all files to delete in the database
-        for producer_index, producer in enumerate(self.producer_list):
-            for path in files:
-                for field_name, pattern in producer.regex_field_patterns().items():
-                    match: Optional[re.Match[str]] = re.match(pattern, path)
-
-                    if match is None:
-                        continue
-
-                    self.remove_file_from_database(self.filecache, producer_index, field_name, path)
+        with self.filecache:
+            for (producer_index, field_name), matches in self.group_field_matches(files).items():
+                self.remove_files_from_database(self.filecache, producer_index, field_name, [filename for filename, _ in matches])
 
 
         pass
@@ -412,7 +832,13 @@ class Scheduler:
     # file instead.
     ############################################################################
     def init_producer_cache(self, producer_list: List[GenericProducer]) -> sqlite3.Connection:
-        db = sqlite3.connect(':memory:')
+        # The same pre-built query strings are executed over and over again.
+        # Size the connection's prepared statement cache so that every one of
+        # them stays prepared instead of being evicted and re-parsed once there
+        # are more than the default 128 statements.
+        statement_count = len(self._insert_sql) + len(self._delete_sql) + len(self._fileset_sql)
+
+        db = sqlite3.connect(':memory:', cached_statements=max(128, statement_count))
 
         for producer_index, producer in enumerate(producer_list):
             for init_query in self.init_table_query(producer_index):
@@ -463,47 +889,38 @@ class Scheduler:
         return query_strings
 
     ############################################################################
-    # insert
+    # insert_new_files
     #
-    # Insert a file that has matched a field for this producer into the
-    # database table for that field.
+    # Insert a batch of files that have matched a field for this producer into
+    # the database table for that field. This does not open a transaction of
+    # its own so that the caller can batch many fields into one transaction.
     ############################################################################
-    def insert_new_file(
+    def insert_new_files(
         self,
         db: sqlite3.Connection,
         producer_index: int,
         field_name: str,
-        filename: str,
-        groups: Dict[str, str]
+        files: List[Tuple[str, Dict[str, str]]],
     ) -> None:
-        
-        query_string, binds = self.insert_new_file_querystring(
-            producer_index=producer_index,
-            field_name=field_name,
-            filename=filename,
-            groups=groups
-        )
+        group_names = self.producer_list[producer_index].get_match_groups(field_name)
 
-        with db:
-            db.execute(
-                query_string,
-                binds,
-            )
+        query_string = self._insert_sql[(producer_index, field_name)]
+
+        db.executemany(
+            query_string,
+            [[filename, self._generation] + [groups[group_name] for group_name in group_names] for filename, groups in files],
+        )
 
     def insert_new_file_querystring(
         self,
         producer_index: int,
         field_name: str,
-        filename: str,
-        groups: Dict[str, str]
-    ) -> Tuple[str, List[str]]:
+    ) -> str:
         producer = self.producer_list[producer_index]
         field_id = producer.get_field_id(field_name)
         table_name = Scheduler.get_field_table_name(producer_index=producer_index, field_id=field_id)
 
-        fields = ["filename", "is_updated"] + [Scheduler.get_match_group_column_name(producer=producer, group_name=group_name) for group_name in groups.keys()]
-
-        binds = [filename, 1] + list(groups.values())
+        fields = ["filename", "is_updated"] + [Scheduler.get_match_group_column_name(producer=producer, group_name=group_name) for group_name in producer.get_match_groups(field_name)]
 
         # query_string: str = "INSERT INTO {table} ({fields}) VALUES ({value_binds}) ON CONFLICT(filename) DO UPDATE SET is_updated=1".format(
         query_string: str = "INSERT INTO {table} ({fields}) VALUES ({value_binds})".format(
@@ -512,24 +929,27 @@ class Scheduler:
             value_binds=", ".join("?" * len(fields))
         )
 
-        return query_string, binds
+        return query_string
 
-    def remove_file_from_database(
+    ############################################################################
+    # remove_files_from_database
+    #
+    # Remove a batch of files from the database table for a producer field.
+    # Like insert_new_files() the caller is in charge of the transaction.
+    ############################################################################
+    def remove_files_from_database(
         self,
         db: sqlite3.Connection,
         producer_index: int,
         field_name: str,
-        filename: str,
+        filenames: List[str],
     ) -> None:
 
-        query_string = self.remove_file_from_database_sql(producer_index, field_name)
-        with db:
-            db.execute(
-                query_string,
-                {
-                    "filename": filename
-                },
-            )
+        query_string = self._delete_sql[(producer_index, field_name)]
+        db.executemany(
+            query_string,
+            [{"filename": filename} for filename in filenames],
+        )
 
     def remove_file_from_database_sql(
         self,
@@ -557,53 +977,62 @@ class Scheduler:
     ############################################################################
     # def query_filesets(self, db: sqlite3.Connection, producer_index: int) -> List[Tuple[InputFileDatatype, Dict[str, str]]]:
     def query_filesets(self, db: sqlite3.Connection, producer_index: int) -> List[Tuple[Any, Dict[str, str]]]:
-        query_string = self.new_filesets_querystring(producer_index)
+        query_string = self._fileset_sql[producer_index]
 
-        producer = self.producer_list[producer_index]
+        input_path_patterns = self._input_path_patterns_by_producer[producer_index]
+        all_match_groups = self.producer_list[producer_index].get_all_match_groups()
 
         # output_data: List[Tuple[InputFileDatatype, Dict[str, str]]] = []
         output_data: List[Tuple[Any, Dict[str, str]]] = []
-        with db:
-            cur = db.execute(
-                query_string,
-            )
 
-            columns = [ x[0] for x in cur.description ]
-            columns_lookup = { value: index for index, value in enumerate(columns) }
-            # print(columns_lookup)
+        # This is a read only query so it does not need to be in a transaction
+        cur = db.execute(
+            query_string,
+            {"generation": self._generation},
+        )
 
-            for row in cur.fetchall():
+        columns = [ x[0] for x in cur.description ]
+        columns_lookup = { value: index for index, value in enumerate(columns) }
+        # print(columns_lookup)
 
-                new_element = {}
-                groups: Dict[str, str] = {}
+        # Resolve the column index of every field and group once instead
+        # of once per row.
+        field_columns: Dict[str, int] = {}
+        for field_name, pattern in input_path_patterns.items():
+            if pattern == "" or pattern == []:
+                continue
+            field_columns[field_name] = columns_lookup["field_" + self._field_id[(producer_index, field_name)]]
 
-                for new_element_field_name, pattern in producer.input_path_patterns_dict().items():
-                    new_element_field_id = producer.get_field_id(new_element_field_name)
-                    if pattern == "":
-                        new_element[new_element_field_name] = ""
-                        continue
-                    elif pattern == []:
-                        new_element[new_element_field_name] = []
-                        continue
+        group_columns: Dict[str, int] = {}
+        for group_name in all_match_groups:
+            group_columns[group_name] = columns_lookup["group_" + self._match_group_id[(producer_index, group_name)]]
+
+        # The query only returns rows where at least one file is updated, and
+        # each of those should have a creator constructed.
+        for row in cur.fetchall():
+            new_element: Dict[str, Union[str, List[str]]] = {}
+            groups: Dict[str, str] = {}
 
-                    value: str = row[columns_lookup["field_"+new_element_field_id]]
-                    if isinstance(pattern, str):
-                        new_element[new_element_field_name] = value
-                    elif isinstance(pattern, list):
-                        new_element[new_element_field_name] = sorted(parse_comma_escape(value))
-                    else:
-                        raise TypeError()
+            for new_element_field_name, pattern in input_path_patterns.items():
+                if pattern == "":
+                    new_element[new_element_field_name] = ""
+                    continue
+                elif pattern == []:
+                    new_element[new_element_field_name] = []
+                    continue
 
-                for group_name in producer.get_all_match_groups():
-                    group_id = producer.get_match_group_id(group_name)
-                    groups[group_name] = row[columns_lookup["group_"+group_id]]
+                value: str = row[field_columns[new_element_field_name]]
+                if isinstance(pattern, str):
+                    new_element[new_element_field_name] = value
+                elif isinstance(pattern, list):
+                    new_element[new_element_field_name] = sorted(parse_comma_escape(value))
+                else:
+                    raise TypeError()
 
+            for group_name, group_column in group_columns.items():
+                groups[group_name] = row[group_column]
 
-                # If at least one file is updated then this creator should be
-                # constructed.
-                is_updated = row[columns_lookup["is_updated"]]
-                if is_updated > 0:
-                    output_data.append((new_element, groups))
+            output_data.append((new_element, groups))
 
         return output_data
 
@@ -671,7 +1100,7 @@ class Scheduler:
                 match_columns = [Scheduler.get_match_group_column_name(producer, match_group) for match_group in producer.get_match_groups(field_name)]
                 new_table_name = table_name + "_mod"
 
-                table_contents = "(SELECT GROUP_CONCAT(REPLACE(REPLACE(filename, '\\','\\\\'), ',', '\\,'), ',') as filename, {match_columns}, SUM(is_updated) as is_updated FROM {table_name} GROUP BY {match_columns}) as {new_table_name}".format(
+                table_contents = "(SELECT GROUP_CONCAT(REPLACE(REPLACE(filename, '\\','\\\\'), ',', '\\,'), ',') as filename, {match_columns}, MAX(is_updated) as is_updated FROM {table_name} GROUP BY {match_columns}) as {new_table_name}".format(
                     table_name=table_name,
                     new_table_name=new_table_name,
                     match_columns=",".join(match_columns)
@@ -697,7 +1126,7 @@ class Scheduler:
                 field_groups[match_group_name].append(table_name)
 
             # Add the is_updated column from this table to the list of columns
-            # to sum as a check if any of the files inside are updated.
+            # to check for any files inserted in the current generation.
             update_tracking_columns.append("{table_name}.is_updated".format(
                 table_name=table_name
             ))
@@ -728,50 +1157,97 @@ class Scheduler:
             field_joins = ["1=1"]
 
 
-        columns.append(
-            "SUM({}) AS \"is_updated\"".format(
-                "+".join(update_tracking_columns)
+        # The newest generation of any file in the fileset. SQLite's MAX() is
+        # the aggregate function with one argument and the scalar function
+        # with more than one, so the columns are combined with the scalar
+        # version first when there are several of them.
+        if len(update_tracking_columns) == 1:
+            newest_generation = "MAX({})".format(update_tracking_columns[0])
+        else:
+            newest_generation = "MAX(MAX({}))".format(
+                ", ".join(update_tracking_columns)
             )
+
+        columns.append(
+            "{} AS \"is_updated\"".format(newest_generation)
         )
 
-        query_string = "SELECT {columns} FROM {field_tables} WHERE {field_wheres} GROUP BY {group_by_columns};".format(
+        # Only return the filesets that have at least one updated file in them.
+        # Filtering in the query means that the filesets which have not
+        # changed never have to be sent back and parsed, so the cost of each
+        # query scales with the number of changed filesets instead of with
+        # every fileset the producer has ever seen.
+        query_string = "SELECT {columns} FROM {field_tables} WHERE {field_wheres} GROUP BY {group_by_columns} HAVING {newest_generation} >= :generation;".format(
             columns=", ".join(columns),
             field_tables=", ".join(tables),
             field_wheres=" AND ".join(field_wheres + field_joins),
-            group_by_columns=", ".join(group_by_columns)
+            group_by_columns=", ".join(group_by_columns),
+            newest_generation=newest_generation,
         )
 
         return query_string
 
 
-    def mark_all_files_old(self, db: sqlite3.Connection) -> None:
-        for mark_files_query in self.mark_all_files_old_querystrings():
-            with db:
-                db.execute(mark_files_query)
 
-    def mark_all_files_old_querystrings(self) -> List[str]:
+################################################################################
+# print_creator
+#
+# Print out the categories and the input and output files of a creator that is
+# being run.
+################################################################################
+def print_creator(creator: GenericCreator, duration: Optional[float] = None) -> None:
+    input_files: List[str] = creator.flat_input_paths()
+    output_files: List[str] = creator.flat_output_paths()
 
-        query_strings = []
-        for producer_index, producer in enumerate(self.producer_list):
-            for field_name, field in producer.input_path_patterns_dict().items():
-                if field == "":
-                    continue
-                elif field == []:
-                    continue
+    # Collect all of the gray lines and write them out with a single color
+    # wrap and a single write call instead of one print per line.
+    lines: List[str] = []
 
-                field_id = producer.get_field_id(field_name)
+    if len(input_files) > 5:
+        lines += ["  " + file for file in input_files[:4]]
+        lines.append("  ...and {} other files".format(len(input_files)-4))
 
-                table_name = Scheduler.get_field_table_name(
-                    producer_index=producer_index,
-                    field_id=field_id
-                )
+    else:
+        lines += ["  " + file for file in input_files]
 
-                query_strings.append("UPDATE {table_name} SET is_updated = 0 WHERE is_updated != 0;".format(
-                    table_name=table_name
-                ))
+    lines.append("  │")
 
-        return query_strings
+    for i, file in enumerate(output_files):
+
+        pipe_character = "├"
+        if (i == len(output_files)-1):
+            pipe_character = "└"
+            # pipe_character = "╰"
 
+        lines.append("  {pipe_character}── {file}".format(
+            pipe_character=pipe_character,
+            file=file,
+        ))
+
+    if duration is not None:
+        lines.append(format_duration(duration))
+
+    sys.stdout.write("\n" + str(creator.categories) + "\n" + fg_gray("\n".join(lines)) + "\n")
+
+
+################################################################################
+# format_duration
+#
+# Format the "Completed in" line that follows a creator being run.
+################################################################################
+def format_duration(duration: float) -> str:
+    return "  Completed in {:.2f}s".format(duration)
+
+
+################################################################################
+# run_creator
+#
+# Run a creator and return how many seconds it took to run.
+################################################################################
+def run_creator(creator: GenericCreator) -> float:
+    start = time.time()
+    creator.run()
+    return time.time() - start
 
 
 ################################################################################
@@ -781,9 +1257,12 @@ class Scheduler:
 # more files does not exist then it will return False. If an empty list is
 # passed in then it will return True.
 ################################################################################
-def all_files_exist(files: List[str]) -> bool:
+def all_files_exist(files: List[str], stat_cache: Optional[StatCache] = None) -> bool:
+    if stat_cache is None:
+        stat_cache = StatCache()
+
     for file in files:
-        if not os.path.exists(file):
+        if stat_cache.get(file) is None:
             return False
     return True
 
@@ -794,11 +1273,26 @@ def all_files_exist(files: List[str]) -> bool:
 # Takes in a list of files and then creates all of the directories needed in
 # order for those files to be written to if they do not already exist.
 ################################################################################
-def build_required_directories(files: List[str]) -> None:
-    for file in files:
-        directory = os.path.dirname(file)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+def build_required_directories(files: List[str], stat_cache: Optional[StatCache] = None) -> None:
+    if stat_cache is None:
+        stat_cache = StatCache()
+
+    # Many output files usually share the same directory, so only check each
+    # directory once. Files in the working directory have no directory to
+    # create.
+    directories = set(os.path.dirname(file) for file in files)
+    directories.discard("")
+
+    # Create the deepest directories first so that their parents are created
+    # along with them instead of with a makedirs() call of their own.
+    for directory in sorted(directories, key=lambda x: x.count(os.sep), reverse=True):
+        if stat_cache.get(directory) is None:
+            # The cache may be out of date if something else created the
+            # directory so allow it to already exist.
+            os.makedirs(directory, exist_ok=True)
+
+            # Any of the directories created may have been cached as missing
+            stat_cache.invalidate_missing_directories(directory)
 
 
 ################################################################################
@@ -807,11 +1301,15 @@ def build_required_directories(files: List[str]) -> None:
 # This function takes in a list of files and returns the most recent time any
 # of them were modified.
 ################################################################################
-def get_newest_modified_time(paths: List[str]) -> float:
+def get_newest_modified_time(paths: List[str], stat_cache: Optional[StatCache] = None) -> float:
+    # A missing file is newer than every other file so the scan can stop as
+    # soon as one is found.
     return get_aggregated_modified_time(
         paths=paths,
         aggregator=max,
         default=sys.float_info.max,
+        stat_cache=stat_cache,
+        stop_at_missing=True,
     )
 
 
@@ -821,11 +1319,12 @@ def get_newest_modified_time(paths: List[str]) -> float:
 # This function takes in a list of files and returns the least recent time any
 # of them were modified.
 ################################################################################
-def get_oldest_modified_time(paths: List[str]) -> float:
+def get_oldest_modified_time(paths: List[str], stat_cache: Optional[StatCache] = None) -> float:
     return get_aggregated_modified_time(
         paths=paths,
         aggregator=min,
         default=0,
+        stat_cache=stat_cache,
     )
 
 
@@ -838,32 +1337,221 @@ def get_oldest_modified_time(paths: List[str]) -> float:
 ################################################################################
 def get_aggregated_modified_time(
     paths: List[str],
-    aggregator: Callable[[List[float]], float],
-    default: float
+    aggregator: Callable[[float, float], float],
+    default: float,
+    stat_cache: Optional[StatCache] = None,
+    stop_at_missing: bool = False,
 ) -> float:
-    # Duplicate the paths list so we can modify it. This allows us to avoid
-    # recursion by just appending the values.
-    paths = list(paths)
-    time_list: List[float] = []
+    _, modified_time = scan_modified_times(paths, aggregator, default, stat_cache, stop_at_missing=stop_at_missing)
+    return modified_time
+
+
+################################################################################
+# get_existing_modified_time
+#
+# Aggregate the modified times of a list of paths like scan_modified_times(),
+# but return None as soon as any of the paths is found to not exist. This
+# checks that every path exists and gets their modified time in one pass.
+################################################################################
+def get_existing_modified_time(
+    paths: List[str],
+    aggregator: Callable[[float, float], float],
+    stat_cache: Optional[StatCache] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> Optional[float]:
+    all_exist, modified_time = scan_modified_times(paths, aggregator, 0, stat_cache, executor, stop_at_missing=True)
+    if not all_exist:
+        return None
+    return modified_time
+
+
+################################################################################
+# scan_modified_times
+#
+# Aggregate the modified times of a list of paths, recursing into directories,
+# while also reporting if every one of the paths exists. This lets a caller
+# check for existence and modified times with a single os.stat() per path
+# instead of calling all_files_exist() and get_*_modified_time() separately.
+# An optional stat cache can be passed in to share stats between calls, and an
+# optional executor to scan large directory trees with. If stop_at_missing is
+# set then the scan stops as soon as a missing path is found.
+################################################################################
+def scan_modified_times(
+    paths: List[str],
+    aggregator: Callable[[float, float], float],
+    default: float,
+    stat_cache: Optional[StatCache] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+    stop_at_missing: bool = False,
+) -> Tuple[bool, float]:
+    if stat_cache is None:
+        stat_cache = StatCache()
+
+    all_exist = True
+
+    # The modified times are folded together as they are found instead of
+    # being collected into a list first. None until the first time is found.
+    aggregated_time: Optional[float] = None
+
+    directories: List[str] = []
     for path in paths:
+        path_stat = stat_cache.get(path)
+
         # If a path is missing add the default value instead
-        if not os.path.exists(path):
-            time_list.append(default)
+        if path_stat is None:
+            if stop_at_missing:
+                return False, default
+            all_exist = False
+            aggregated_time = fold_modified_time(aggregated_time, default, aggregator)
             continue
 
-        # If a path is a directory add all its children to the paths list
-        if (os.path.isdir(path)):
-            for subpath in os.listdir(path):
-                paths.append(os.path.join(path, subpath))
+        if stat.S_ISDIR(path_stat.st_mode):
+            directories.append(path)
         else:
-            time_list.append(os.path.getmtime(path))
+            aggregated_time = fold_modified_time(aggregated_time, path_stat.st_mtime, aggregator)
+
+    # Walk the directories on this thread until there are enough of them to
+    # be worth scanning in parallel.
+    while len(directories) > 0:
+        if executor is not None and len(directories) >= PARALLEL_SCAN_MIN_DIRECTORIES:
+            break
+
+        directory_all_exist, directory_time, subdirectories = scan_directory(directories.pop(), aggregator, stat_cache)
+        if not directory_all_exist:
+            if stop_at_missing:
+                return False, default
+            all_exist = False
+            aggregated_time = fold_modified_time(aggregated_time, default, aggregator)
+        aggregated_time = fold_modified_time(aggregated_time, directory_time, aggregator)
+        directories += subdirectories
+
+    # Scan any remaining directories on the thread pool. Each directory that
+    # is found is submitted as its own task as soon as its parent is scanned.
+    if executor is not None and len(directories) > 0:
+        pending = {executor.submit(scan_directory, directory, aggregator, stat_cache) for directory in directories}
+        try:
+            while len(pending) > 0:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    directory_all_exist, directory_time, subdirectories = future.result()
+                    if not directory_all_exist:
+                        if stop_at_missing:
+                            return False, default
+                        all_exist = False
+                        aggregated_time = fold_modified_time(aggregated_time, default, aggregator)
+                    aggregated_time = fold_modified_time(aggregated_time, directory_time, aggregator)
+                    for subdirectory in subdirectories:
+                        pending.add(executor.submit(scan_directory, subdirectory, aggregator, stat_cache))
+        finally:
+            # Scans that have already started cannot be cancelled and write
+            # into the stat cache, so wait for them to finish before the
+            # caller goes on to write files and invalidate the cache.
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+
+    # If there were no timestamps at all then use the default
+    if aggregated_time is None:
+        return all_exist, default
+
+    return all_exist, aggregated_time
 
-    # Sanity check that there are timestamps in the list before passing them
-    # to the aggregator.
-    if len(time_list) == 0:
-        return default
 
-    return aggregator(time_list)
+################################################################################
+# fold_modified_time
+#
+# Fold a modified time into a running aggregate of modified times, where
+# either one can be None if there is nothing to fold in yet.
+################################################################################
+def fold_modified_time(
+    aggregated_time: Optional[float],
+    modified_time: Optional[float],
+    aggregator: Callable[[float, float], float],
+) -> Optional[float]:
+    if aggregated_time is None:
+        return modified_time
+    if modified_time is None:
+        return aggregated_time
+    return aggregator(aggregated_time, modified_time)
+
+
+################################################################################
+# scan_directory
+#
+# Scan a single directory with os.scandir() so that the type of every child
+# comes from the directory listing itself. Returns if every file in the
+# directory exists, the aggregated modified time of the files, or None if
+# there are no files, and the sub directories which still need to be scanned.
+# Sub directories are not stat'd.
+################################################################################
+def scan_directory(
+    path: str,
+    aggregator: Callable[[float, float], float],
+    stat_cache: StatCache,
+) -> Tuple[bool, Optional[float], List[str]]:
+    all_exist = True
+    aggregated_time: Optional[float] = None
+    subdirectories: List[str] = []
+
+    # The aggregator is almost always the built-in max() or min(). Comparing
+    # the times directly for those avoids a function call for every file.
+    is_newest = aggregator is max
+    is_oldest = aggregator is min
+
+    # Reuse the listing of the directory if it has already been scanned this
+    # pass, otherwise list it and stat the files as they are found.
+    file_stats: List[Optional[os.stat_result]] = []
+    listing = stat_cache.get_listing(path)
+    if listing is not None:
+        files, subdirectories = listing
+        file_stats = [stat_cache.get(file) for file in files]
+    else:
+        files = []
+        directory_fd: Optional[int] = None
+        if SCANDIR_SUPPORTS_FD:
+            directory_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+        try:
+            with os.scandir(path if directory_fd is None else directory_fd) as entries:
+                for entry in entries:
+                    # Entries listed from a file descriptor only know their name
+                    entry_path = os.path.join(path, entry.name)
+
+                    if entry.is_dir():
+                        subdirectories.append(entry_path)
+                        continue
+
+                    files.append(entry_path)
+                    file_stats.append(stat_cache.get_entry(entry_path, entry))
+        finally:
+            if directory_fd is not None:
+                os.close(directory_fd)
+
+        stat_cache.set_listing(path, files, subdirectories)
+
+    for file_stat in file_stats:
+        # A child can be missing if it is a broken symlink
+        if file_stat is None:
+            all_exist = False
+            continue
+
+        modified_time = file_stat.st_mtime
+        if aggregated_time is None:
+            aggregated_time = modified_time
+        elif is_newest:
+            if modified_time > aggregated_time:
+                aggregated_time = modified_time
+        elif is_oldest:
+            if modified_time < aggregated_time:
+                aggregated_time = modified_time
+        else:
+            aggregated_time = aggregator(aggregated_time, modified_time)
+
+    return all_exist, aggregated_time, subdirectories
+
+
+# Matches a comma that has not been escaped with a backslash
+UNESCAPED_COMMA_REGEX = re.compile(r"(?<!\\),")
 
 
 ################################################################################
@@ -875,16 +1563,17 @@ def get_aggregated_modified_time(
 # TODO: The SQL logic should somehow be moved to scheduler.py
 ################################################################################
 def parse_comma_escape(input_string: str) -> List[str]:
-    output_strings: List[str] = [""]
-    last_character: str = ""
-    for character in input_string:
-        if character == "," and last_character != "\\":
-            output_strings.append("")
-        elif character == "\\" and last_character != "\\":
-            pass
-        else:
-            output_strings[-1] += character
-
-        last_character = character
-
-    return output_strings
+    # Almost no filenames contain a comma or a backslash, and without any
+    # escapes every comma is a delimiter.
+    if "\\" not in input_string:
+        return input_string.split(",")
+
+    # Swap every escaped backslash for a NUL character, which can never be
+    # part of a filename. Every backslash that is left is then escaping the
+    # comma that comes after it, so only the unescaped commas are split on.
+    unescaped_backslashes = input_string.replace("\\\\", "\0")
+
+    return [
+        x.replace("\\,", ",").replace("\0", "\\")
+        for x in UNESCAPED_COMMA_REGEX.split(unescaped_backslashes)
+    ]
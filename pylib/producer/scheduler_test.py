@@ -1,9 +1,18 @@
 from typing import Dict, List, Tuple, TypedDict
+import concurrent.futures
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+import time
 import unittest
 
 from .creator import Creator
 from .producer import Producer
-from .scheduler import Scheduler
+from .scheduler import Scheduler, get_pattern_extension, get_path_extension, scan_modified_times, get_existing_modified_time, build_required_directories, parse_comma_escape
+from .stat_cache import StatCache
 
 
 # TODO: dont use scheduler.build_new_creators() instead just create the files
@@ -11,6 +20,351 @@ from .scheduler import Scheduler
 # to support working directory inputs instead of using the current working
 # directory as the base dir.
 
+class Extension_Tests(unittest.TestCase):
+    def test_pattern_extension(self) -> None:
+        self.assertEqual(get_pattern_extension(r"^data_(?P<title>[a-z]+)\.txt$"), ".txt")
+        self.assertEqual(get_pattern_extension(r"^global_configs?\.txt$"), ".txt")
+        self.assertEqual(get_pattern_extension(r"^cache/(?P<dir>a|b)/data\.tar\.gz$"), ".gz")
+        self.assertEqual(get_pattern_extension(r"^price\.json\$$"), ".json$")
+
+    def test_pattern_without_extension(self) -> None:
+        # Not anchored to the end of the path
+        self.assertIsNone(get_pattern_extension(r"^cache/calculator\.css\.json"))
+        # Alternation or wildcards in the extension
+        self.assertIsNone(get_pattern_extension(r"^output/.*\.(?:html|js|css)$"))
+        self.assertIsNone(get_pattern_extension(r"^a\.txt$|^b\.png$"))
+        self.assertIsNone(get_pattern_extension(r"^data.txt$"))
+        # An escaped dollar sign is a literal character and not an anchor
+        self.assertIsNone(get_pattern_extension(r"^price\.json\$"))
+        # Quantifiers and character classes in the extension
+        self.assertIsNone(get_pattern_extension(r"^data\.tx?t$"))
+        self.assertIsNone(get_pattern_extension(r"^data\.t{2}$"))
+        self.assertIsNone(get_pattern_extension(r"^data\.[tx]t$"))
+        # Flags that change what the literal characters match
+        self.assertIsNone(get_pattern_extension(r"(?i)^data\.txt$", re.IGNORECASE))
+
+    def test_path_extension(self) -> None:
+        self.assertEqual(get_path_extension("data_one.txt"), ".txt")
+        self.assertEqual(get_path_extension("cache/data.tar.gz"), ".gz")
+        self.assertEqual(get_path_extension("cache.d/data"), "")
+        self.assertEqual(get_path_extension("data.txt\n"), ".txt")
+
+
+class Comma_Escape_Tests(unittest.TestCase):
+    def test_parse_comma_escape(self) -> None:
+        self.assertEqual(parse_comma_escape(""), [""])
+        self.assertEqual(parse_comma_escape("a.txt"), ["a.txt"])
+        self.assertEqual(parse_comma_escape("a.txt,b.txt"), ["a.txt", "b.txt"])
+        self.assertEqual(parse_comma_escape("a\\,b.txt,c.txt"), ["a,b.txt", "c.txt"])
+        self.assertEqual(parse_comma_escape("a\\\\b.txt,c.txt"), ["a\\b.txt", "c.txt"])
+
+    def test_trailing_backslash(self) -> None:
+        # An escaped backslash right before a delimiter does not escape it
+        self.assertEqual(parse_comma_escape("a\\\\,b.txt"), ["a\\", "b.txt"])
+        self.assertEqual(parse_comma_escape("a\\\\\\,b.txt"), ["a\\,b.txt"])
+
+
+class Modified_Time_Tests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+
+        # Build a small tree of files with known modified times
+        #   a.txt          100
+        #   nested/b.txt   200
+        #   nested/c/d.txt 300
+        os.makedirs(os.path.join(self.root, "nested", "c"))
+        for path, modified_time in [
+            ("a.txt", 100),
+            (os.path.join("nested", "b.txt"), 200),
+            (os.path.join("nested", "c", "d.txt"), 300),
+        ]:
+            full_path = os.path.join(self.root, path)
+            with open(full_path, "w") as f:
+                f.write(path)
+            os.utime(full_path, (modified_time, modified_time))
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_files(self) -> None:
+        paths = [os.path.join(self.root, "a.txt"), os.path.join(self.root, "nested", "b.txt")]
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max), (True, 200))
+        self.assertEqual(scan_modified_times(paths, min, 0), (True, 100))
+
+    def test_directory(self) -> None:
+        paths = [os.path.join(self.root, "nested")]
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max), (True, 300))
+        self.assertEqual(scan_modified_times(paths, min, 0), (True, 200))
+
+    def test_cached_listing(self) -> None:
+        stat_cache = StatCache()
+        paths = [os.path.join(self.root, "nested")]
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max, stat_cache), (True, 300))
+
+        # A new file is not seen until it is invalidated in the cache
+        new_file = os.path.join(self.root, "nested", "c", "e.txt")
+        with open(new_file, "w") as f:
+            f.write("e")
+        os.utime(new_file, (400, 400))
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max, stat_cache), (True, 300))
+
+        stat_cache.invalidate([new_file])
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max, stat_cache), (True, 400))
+
+    def test_custom_aggregator(self) -> None:
+        paths = [os.path.join(self.root, "nested")]
+        self.assertEqual(scan_modified_times(paths, lambda a, b: max(a, b), sys.float_info.max), (True, 300))
+        self.assertEqual(scan_modified_times(paths, lambda a, b: min(a, b), 0), (True, 200))
+
+    def test_missing_file(self) -> None:
+        paths = [os.path.join(self.root, "a.txt"), os.path.join(self.root, "missing.txt")]
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max), (False, sys.float_info.max))
+        self.assertEqual(scan_modified_times(paths, min, 0), (False, 0))
+
+    def test_existing_modified_time(self) -> None:
+        paths = [os.path.join(self.root, "a.txt"), os.path.join(self.root, "nested")]
+        self.assertEqual(get_existing_modified_time(paths, min), 100)
+        self.assertEqual(get_existing_modified_time(paths, max), 300)
+        self.assertIsNone(get_existing_modified_time(paths + [os.path.join(self.root, "missing.txt")], min))
+
+        os.symlink(os.path.join(self.root, "missing.txt"), os.path.join(self.root, "nested", "c", "broken.txt"))
+        self.assertIsNone(get_existing_modified_time(paths, min))
+
+    def test_broken_symlink_in_directory(self) -> None:
+        os.symlink(os.path.join(self.root, "missing.txt"), os.path.join(self.root, "nested", "broken.txt"))
+        paths = [os.path.join(self.root, "nested")]
+        self.assertEqual(scan_modified_times(paths, max, sys.float_info.max), (False, sys.float_info.max))
+        self.assertEqual(scan_modified_times(paths, min, 0), (False, 0))
+
+    def test_parallel_directories(self) -> None:
+        # Enough sibling directories to be scanned on the thread pool
+        for index in range(8):
+            directory = os.path.join(self.root, "nested", "c", "wide{}".format(index))
+            os.makedirs(os.path.join(directory, "deeper"))
+            for path, modified_time in [
+                (os.path.join(directory, "e.txt"), 400 + index),
+                (os.path.join(directory, "deeper", "f.txt"), 500 + index),
+            ]:
+                with open(path, "w") as f:
+                    f.write(path)
+                os.utime(path, (modified_time, modified_time))
+
+        paths = [os.path.join(self.root, "nested")]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(scan_modified_times(paths, max, sys.float_info.max, executor=executor), (True, 507))
+            self.assertEqual(scan_modified_times(paths, min, 0, executor=executor), (True, 200))
+
+            os.symlink(os.path.join(self.root, "missing.txt"), os.path.join(self.root, "nested", "c", "wide3", "deeper", "broken.txt"))
+            self.assertEqual(scan_modified_times(paths, min, 0, executor=executor), (False, 0))
+
+    def test_parallel_stop_at_missing_waits(self) -> None:
+        for index in range(8):
+            directory = os.path.join(self.root, "nested", "c", "wide{}".format(index))
+            os.makedirs(os.path.join(directory, "deeper"))
+        os.symlink(os.path.join(self.root, "missing.txt"), os.path.join(self.root, "nested", "c", "wide0", "broken.txt"))
+
+        # Record every scan that is submitted so that they can be checked
+        # once the scan has returned early. Every scan except the one that
+        # finds the broken symlink is slowed down so that they are still
+        # running when the missing file is found.
+        futures: List["concurrent.futures.Future[object]"] = []
+
+        class RecordingExecutor(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, function, path, *args, **kwargs):  # type: ignore
+                def slow_function(*args, **kwargs):  # type: ignore
+                    if not path.endswith("wide0"):
+                        time.sleep(0.1)
+                    return function(*args, **kwargs)
+
+                future = super().submit(slow_function, path, *args, **kwargs)
+                futures.append(future)
+                return future
+
+        paths = [os.path.join(self.root, "nested")]
+        with RecordingExecutor(max_workers=4) as executor:
+            self.assertIsNone(get_existing_modified_time(paths, min, StatCache(), executor))
+
+            # No scan can still be running and writing into the stat cache
+            self.assertGreater(len(futures), 0)
+            self.assertTrue(all(future.done() for future in futures))
+
+    def test_empty(self) -> None:
+        self.assertEqual(scan_modified_times([], max, sys.float_info.max), (True, sys.float_info.max))
+        self.assertEqual(scan_modified_times([], min, 0), (True, 0))
+
+
+class Build_Required_Directories_Tests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.tempdir.name)
+
+    def tearDown(self) -> None:
+        os.chdir(self.original_cwd)
+        self.tempdir.cleanup()
+
+    def test_build_directories(self) -> None:
+        build_required_directories([
+            "output.txt",
+            os.path.join("a", "one.txt"),
+            os.path.join("a", "two.txt"),
+            os.path.join("a", "b", "c", "three.txt"),
+        ])
+        self.assertTrue(os.path.isdir(os.path.join("a", "b", "c")))
+
+        # Existing directories are left alone
+        build_required_directories([os.path.join("a", "b", "four.txt")])
+        self.assertTrue(os.path.isdir(os.path.join("a", "b", "c")))
+
+
+class Process_Files_Tests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.tempdir.name)
+
+        # The files that have been created, in the order they were created
+        self.runs: List[str] = []
+
+        class SingleFile(TypedDict):
+            file: str
+
+        def function(input_files: SingleFile, output_files: SingleFile) -> None:
+            with open(input_files["file"]) as f:
+                data = f.read()
+            with open(output_files["file"], "w") as f:
+                f.write(data)
+            self.runs.append(output_files["file"])
+
+        def copy_paths(input_files: SingleFile, groups: Dict[str, str]) -> Tuple[SingleFile, SingleFile]:
+            return (input_files, {"file": "cache/" + groups["name"] + ".txt"})
+
+        def final_paths(input_files: SingleFile, groups: Dict[str, str]) -> Tuple[SingleFile, SingleFile]:
+            return (input_files, {"file": "output/final/" + groups["name"] + ".txt"})
+
+        # Producers are deliberately listed in reverse of the order that they
+        # need to run in.
+        self.producers: List[Producer[SingleFile, SingleFile]] = [
+            Producer(
+                input_path_patterns={"file": r"^cache/(?P<name>[a-z]+)\.txt$"},
+                paths=final_paths,
+                function=function,
+                categories=["final"],
+            ),
+            Producer(
+                input_path_patterns={"file": r"^src_(?P<name>[a-z]+)\.txt$"},
+                paths=copy_paths,
+                function=function,
+                categories=["copy"],
+            ),
+        ]
+
+        for name in ["one", "two"]:
+            with open("src_" + name + ".txt", "w") as f:
+                f.write(name)
+
+    def tearDown(self) -> None:
+        os.chdir(self.original_cwd)
+        self.tempdir.cleanup()
+
+    def build_scheduler(self, parallel: bool = False) -> Scheduler:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Scheduler(
+                producer_list=list(self.producers),
+                initial_filepaths=["src_one.txt", "src_two.txt"],
+                parallel=parallel,
+            )
+
+    def test_initial_build(self) -> None:
+        self.build_scheduler()
+
+        self.assertCountEqual(self.runs, [
+            "cache/one.txt",
+            "cache/two.txt",
+            "output/final/one.txt",
+            "output/final/two.txt",
+        ])
+        # Every file must be created before anything that depends on it
+        self.assertLess(self.runs.index("cache/one.txt"), self.runs.index("output/final/one.txt"))
+        self.assertLess(self.runs.index("cache/two.txt"), self.runs.index("output/final/two.txt"))
+
+        with open("output/final/two.txt") as f:
+            self.assertEqual(f.read(), "two")
+
+    def test_close(self) -> None:
+        scheduler = self.build_scheduler(parallel=True)
+        executor = scheduler._executor
+        assert executor is not None
+
+        scheduler.close()
+        self.assertIsNone(scheduler._executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+        # Closing more than once is allowed
+        scheduler.close()
+
+    def test_parallel_build(self) -> None:
+        scheduler = self.build_scheduler(parallel=True)
+        self.addCleanup(scheduler.close)
+
+        self.assertCountEqual(self.runs, [
+            "cache/one.txt",
+            "cache/two.txt",
+            "output/final/one.txt",
+            "output/final/two.txt",
+        ])
+        # Both intermediate files are at the same depth so they are run
+        # together before either of the final outputs.
+        self.assertCountEqual(self.runs[:2], ["cache/one.txt", "cache/two.txt"])
+
+        with open("output/final/two.txt") as f:
+            self.assertEqual(f.read(), "two")
+
+    def test_up_to_date_rebuild(self) -> None:
+        scheduler = self.build_scheduler()
+        self.runs.clear()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.add_or_update_files(["src_one.txt", "src_two.txt"])
+
+        self.assertEqual(self.runs, [])
+
+    def test_modified_file_rebuild(self) -> None:
+        scheduler = self.build_scheduler()
+        self.runs.clear()
+
+        # Modify one of the source files so it is newer than its outputs
+        with open("src_one.txt", "w") as f:
+            f.write("new")
+        newer_time = os.path.getmtime("output/final/one.txt") + 10
+        os.utime("src_one.txt", (newer_time, newer_time))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.add_or_update_files(["src_one.txt"])
+
+        self.assertEqual(self.runs, ["cache/one.txt", "output/final/one.txt"])
+        with open("output/final/one.txt") as f:
+            self.assertEqual(f.read(), "new")
+
+    def test_dependency_order(self) -> None:
+        scheduler = self.build_scheduler()
+        self.runs.clear()
+
+        # Make both the source file and the intermediate file out of date. The
+        # intermediate file should be rebuilt before the final output, so the
+        # final output should only be built once.
+        final_time = os.path.getmtime("output/final/one.txt")
+        os.utime("cache/one.txt", (final_time + 10, final_time + 10))
+        os.utime("src_one.txt", (final_time + 20, final_time + 20))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.add_or_update_files(["cache/one.txt", "src_one.txt"])
+
+        self.assertEqual(self.runs, ["cache/one.txt", "output/final/one.txt"])
+
+
 class Integration_Tests(unittest.TestCase):
     maxDiff = 999999
 
@@ -62,7 +416,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -144,7 +498,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -221,7 +575,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -303,7 +657,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -382,7 +736,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -486,7 +840,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -597,7 +951,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -665,7 +1019,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -736,7 +1090,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -807,7 +1161,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -882,7 +1236,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -906,7 +1260,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -982,7 +1336,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -1067,7 +1421,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -1127,7 +1481,7 @@ class Integration_Tests(unittest.TestCase):
         )
 
         self.assertCountEqual(
-            scheduler.creator_list.values(),
+            scheduler.all_creators(),
             [
                 Creator(
                     input_paths={
@@ -1143,6 +1497,66 @@ class Integration_Tests(unittest.TestCase):
             ]
         )
 
+    ############################################################################
+    # test_duplicate_file_in_batch
+    #
+    # Test that a file passed more than once in the same batch of files is only
+    # stored once and still produces a single creator.
+    ############################################################################
+    def test_duplicate_file_in_batch(self) -> None:
+        class InputFileDatatype(TypedDict):
+            data_file: str
+            value_files: List[str]
+
+        class OutputFileDatatype(TypedDict):
+            data_file: str
+
+        def paths(input_files: InputFileDatatype, groups: Dict[str, str]) -> Tuple[InputFileDatatype, OutputFileDatatype]:
+            return (input_files, {"data_file": "output_" + groups["title"] + ".txt"})
+
+        def function(input_files: InputFileDatatype, output_files: OutputFileDatatype) -> None:
+            return None  # pragma: no cover
+
+        producer: Producer[InputFileDatatype, OutputFileDatatype] = Producer(
+            input_path_patterns={
+                "data_file": r"^data_(?P<title>[a-z]+)\.txt$",
+                "value_files": [r"value_(?P<title>[a-z]+).*\.txt$"],
+            },
+            paths=paths,
+            function=function,
+            categories=["test"],
+        )
+
+        scheduler = Scheduler(
+            producer_list=[producer],
+            initial_filepaths=[],
+        )
+        scheduler.build_new_creators(
+            [
+                'data_one.txt',
+                'value_one_1.txt',
+                'value_one_1.txt',
+                'data_one.txt',
+            ]
+        )
+
+        self.assertCountEqual(
+            scheduler.all_creators(),
+            [
+                Creator(
+                    input_paths={
+                        "data_file": "data_one.txt",
+                        "value_files": ["value_one_1.txt"],
+                    },
+                    output_paths={
+                        "data_file": "output_one.txt"
+                    },
+                    function=function,
+                    categories=["test"]
+                ),
+            ]
+        )
+
     # TODO: Add a test like test_new_file_in_group but where regex for the new
     # file does not have a regex group in it
 
@@ -1191,7 +1605,7 @@ class Integration_Tests(unittest.TestCase):
     #     )
 
     #     self.assertCountEqual(
-    #         scheduler.creator_list.values(),
+    #         scheduler.all_creators(),
     #         [
     #             Creator(
     #                 input_paths={
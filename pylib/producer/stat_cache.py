@@ -0,0 +1,127 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+import stat
+
+
+################################################################################
+# StatCache
+#
+# A cache of os.stat() results for a set of paths, and of the contents of any
+# directories that have been listed. Paths that do not exist are cached as
+# None. The cache is meant to be short lived, for example for one
+# pass over the creators that need to be processed, and any path that is
+# written to while the cache is alive needs to be invalidated.
+#
+# Each lookup is a single dict operation so a cache can be shared between
+# threads that are only reading from the filesystem.
+################################################################################
+class StatCache:
+    _stats: Dict[str, Optional[os.stat_result]]
+
+    # The file paths and sub directory paths inside of each listed directory
+    _listings: Dict[str, Tuple[List[str], List[str]]]
+
+    def __init__(self) -> None:
+        self._stats = {}
+        self._listings = {}
+
+    ############################################################################
+    # get
+    #
+    # os.stat() a path, or return the result from the last time it was stat'd.
+    # Returns None if the path does not exist.
+    ############################################################################
+    def get(self, path: str) -> Optional[os.stat_result]:
+        if path in self._stats:
+            return self._stats[path]
+
+        path_stat: Optional[os.stat_result]
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            path_stat = None
+
+        self._stats[path] = path_stat
+        return path_stat
+
+    ############################################################################
+    # get_entry
+    #
+    # The same as get() but for an os.DirEntry from os.scandir(), which can
+    # reuse information from the directory listing when stat'ing. The path of
+    # the entry is passed in separately because entries listed from a file
+    # descriptor only know their own name.
+    ############################################################################
+    def get_entry(self, path: str, entry: "os.DirEntry[str]") -> Optional[os.stat_result]:
+        if path in self._stats:
+            return self._stats[path]
+
+        entry_stat: Optional[os.stat_result]
+        try:
+            entry_stat = entry.stat()
+        except OSError:
+            entry_stat = None
+
+        self._stats[path] = entry_stat
+        return entry_stat
+
+    ############################################################################
+    # get_listing
+    #
+    # Get the file paths and the sub directory paths inside of a directory if
+    # the directory has already been listed, or None if it has not been.
+    ############################################################################
+    def get_listing(self, path: str) -> Optional[Tuple[List[str], List[str]]]:
+        return self._listings.get(path)
+
+    ############################################################################
+    # set_listing
+    #
+    # Save the file paths and sub directory paths that were found inside of a
+    # directory so that it does not need to be listed again.
+    ############################################################################
+    def set_listing(self, path: str, files: List[str], subdirectories: List[str]) -> None:
+        self._listings[path] = (files, subdirectories)
+
+    ############################################################################
+    # invalidate
+    #
+    # Remove a list of paths that have been written to from the cache, along
+    # with the listing of the directory each path is in. If any of the paths
+    # were cached as directories then everything cached inside of those
+    # directories is removed as well.
+    ############################################################################
+    def invalidate(self, paths: Iterable[str]) -> None:
+        for path in paths:
+            path_stat = self._stats.pop(path, None)
+            path_listing = self._listings.pop(path, None)
+
+            # Writing to a path can add it to the directory it is in
+            self._listings.pop(os.path.dirname(path), None)
+
+            is_directory = path_stat is not None and stat.S_ISDIR(path_stat.st_mode)
+            if is_directory or path_listing is not None:
+                directory_prefix = os.path.join(path, "")
+                for cached_path in [x for x in self._stats if x.startswith(directory_prefix)]:
+                    del self._stats[cached_path]
+                for cached_path in [x for x in self._listings if x.startswith(directory_prefix)]:
+                    del self._listings[cached_path]
+
+    ############################################################################
+    # invalidate_missing_directories
+    #
+    # Remove a directory that has just been created, along with any of its
+    # parent directories, from the cache if they were cached as missing. The
+    # listings of the parent directories are removed too because one of them
+    # now has a new directory inside of it.
+    ############################################################################
+    def invalidate_missing_directories(self, directory: str) -> None:
+        while True:
+            if directory in self._stats and self._stats[directory] is None:
+                del self._stats[directory]
+
+            parent_directory = os.path.dirname(directory)
+            self._listings.pop(parent_directory, None)
+            if parent_directory == directory:
+                break
+            directory = parent_directory
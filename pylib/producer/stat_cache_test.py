@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from .stat_cache import StatCache
+
+
+class StatCache_Tests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.directory = os.path.join(self.root, "directory")
+        self.file = os.path.join(self.directory, "file.txt")
+
+        os.makedirs(self.directory)
+        with open(self.file, "w") as f:
+            f.write("file")
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_cached_results(self) -> None:
+        stat_cache = StatCache()
+        file_stat = stat_cache.get(self.file)
+        self.assertIsNotNone(file_stat)
+
+        # The cached result is returned even after the file is removed
+        os.remove(self.file)
+        self.assertIs(stat_cache.get(self.file), file_stat)
+
+        stat_cache.invalidate([self.file])
+        self.assertIsNone(stat_cache.get(self.file))
+
+    def test_entry(self) -> None:
+        stat_cache = StatCache()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                entry_stat = stat_cache.get_entry(entry.path, entry)
+                self.assertIsNotNone(entry_stat)
+                self.assertIs(stat_cache.get(entry.path), entry_stat)
+
+    def test_invalidate_directory(self) -> None:
+        stat_cache = StatCache()
+        stat_cache.get(self.directory)
+        stat_cache.get(self.file)
+
+        # Invalidating a directory invalidates everything inside of it
+        os.remove(self.file)
+        stat_cache.invalidate([self.directory])
+        self.assertIsNone(stat_cache.get(self.file))
+
+    def test_invalidate_missing_directories(self) -> None:
+        stat_cache = StatCache()
+        new_directory = os.path.join(self.root, "new")
+        new_subdirectory = os.path.join(new_directory, "sub")
+        self.assertIsNone(stat_cache.get(new_directory))
+        self.assertIsNone(stat_cache.get(new_subdirectory))
+
+        os.makedirs(new_subdirectory)
+        stat_cache.invalidate_missing_directories(new_subdirectory)
+        self.assertIsNotNone(stat_cache.get(new_directory))
+        self.assertIsNotNone(stat_cache.get(new_subdirectory))
+
+    def test_invalidate_listing(self) -> None:
+        stat_cache = StatCache()
+        stat_cache.set_listing(self.root, [], [self.directory])
+        stat_cache.set_listing(self.directory, [self.file], [])
+
+        # Writing a file invalidates the listing of the directory it is in
+        stat_cache.invalidate([self.file])
+        self.assertIsNotNone(stat_cache.get_listing(self.root))
+        self.assertIsNone(stat_cache.get_listing(self.directory))
+
+        # Invalidating a directory invalidates the listings inside of it
+        stat_cache.set_listing(self.directory, [self.file], [])
+        stat_cache.invalidate([self.root])
+        self.assertIsNone(stat_cache.get_listing(self.directory))
+
+    def test_invalidate_missing_directories_listing(self) -> None:
+        stat_cache = StatCache()
+        stat_cache.set_listing(self.root, [], [self.directory])
+
+        new_directory = os.path.join(self.root, "new")
+        os.makedirs(new_directory)
+        stat_cache.invalidate_missing_directories(new_directory)
+        self.assertIsNone(stat_cache.get_listing(self.root))
@@ -25,6 +25,9 @@ class UniqueHeap(Generic[T]):
         heapq.heappush(self._heap, obj)
         return True
 
+    def peek(self) -> T:
+        return self._heap[0]
+
     def pop(self) -> T:
         obj: T = heapq.heappop(self._heap)
         self._set.remove(obj)